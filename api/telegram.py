@@ -1,37 +1,108 @@
 import os
 import asyncio
-from typing import Optional, Any
-
+import base64
+import hashlib
+import hmac
+import time
+from itertools import islice
+from typing import Optional, Dict
+
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Header, HTTPException, Depends, Form
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, PlainTextResponse
-from telegram import Update
-
-from bot import build_application
-from db import init_db, list_users, stats_summary, get_promo_stats, get_user_promo_codes
+from fastapi import FastAPI, Request, Header, HTTPException, Form
+from fastapi.responses import Response, HTMLResponse, RedirectResponse, PlainTextResponse
+from markupsafe import escape
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "")
-
-# Pre-build PTB application; initialize on startup to avoid per-request cold init
-ptb_app = build_application()
+# Pre-encoded for hmac.compare_digest
+_WEBHOOK_SECRET_B = WEBHOOK_SECRET.encode()
+_ADMIN_SECRET_B = ADMIN_SECRET.encode()
+# ACK webhook before handlers finish; only safe on long-lived hosts (not serverless)
+WEBHOOK_ACK_EAGER = os.getenv("WEBHOOK_ACK_EAGER", "0") == "1"
+
+# PTB application is built on first use: importing bot/telegram is the bulk of
+# cold start, and health/login/admin shells never need it
+ptb_app = None
 _initialized = False
+_init_lock = asyncio.Lock()
+_schema_ready = False
+# Broadcast fan-out limits
+BROADCAST_CONCURRENCY = 25
+BROADCAST_BATCH_SIZE = 500
+
+# Health probe DB check cache
+HEALTH_TTL_SECONDS = 5.0
+_health_cache = {"t": float("-inf"), "db_ok": True, "db_error": None}
+
+# Update kinds the bot's handlers consume (commands/messages/contacts and callbacks)
+_HANDLED_UPDATE_KEYS = ("message", "edited_message", "callback_query")
+
+# Webhook ACK body never changes; build it once and return the same instance
+_ACK = Response(content=b'{"ok":true}', media_type="application/json")
 
 fastapi_app = FastAPI(title="FILS Design Telegram Webhook")
 # Vercel expects a module-level variable named `app` for ASGI.
 app = fastapi_app
 
 
-def admin_layout(*, title: str, active: str, body: str) -> HTMLResponse:
-    # active in {"users","stats","broadcasts","promos","home"}
-    def a(href: str, text: str, key: str) -> str:
-        on = " class=\"active\"" if key == active else ""
-        return f"<a href=\"{href}\"{on}>{text}</a>"
-
-    html = f"""
+# (href, text, key) for the admin sidebar
+_NAV_ITEMS = (
+    ("/admin", "Главная", "home"),
+    ("/admin/users", "Пользователи", "users"),
+    ("/admin/stats", "Статистика", "stats"),
+    ("/admin/promos", "Промокоды", "promos"),
+    ("/admin/broadcasts", "Рассылки", "broadcasts"),
+)
+
+# Admin CSS is served once from /admin/static/style.css and cached by the browser
+_CSS = """
+:root {
+  --bg: #0f1113;
+  --panel: #15181b;
+  --muted: #7c8a99;
+  --text: #e7edf2;
+  --brand: #a4b1bc; /* спокойный серо-голубой */
+  --accent: #c9d4dc; /* светлый для границ */
+  --ok: #3ecf8e;
+  --danger: #ff5a5f;
+}
+* { box-sizing: border-box; }
+body { margin: 0; background: var(--bg); color: var(--text); font-family: 'Roboto', system-ui, -apple-system, Segoe UI, Arial, sans-serif; }
+.wrap { display: grid; grid-template-columns: 240px 1fr; min-height: 100vh; }
+aside { background: var(--panel); border-right: 1px solid #1d2226; padding: 24px 16px; position: sticky; top: 0; height: 100vh; }
+.brand { font-weight: 700; letter-spacing: .5px; color: var(--brand); margin: 0 0 16px; }
+nav a { display: block; padding: 10px 12px; color: var(--text); text-decoration: none; border-radius: 8px; margin-bottom: 6px; border: 1px solid transparent; }
+nav a:hover { background: #1a1f24; border-color: #20262b; }
+nav a.active { background: #1b2026; border-color: var(--accent); color: #fff; }
+.content { padding: 28px 28px 48px; }
+h1, h2 { margin: 0 0 14px; font-weight: 600; }
+.panel { background: var(--panel); border: 1px solid #1d2226; border-radius: 12px; padding: 18px; }
+.muted { color: var(--muted); }
+.error { color: var(--danger); margin: 8px 0 16px; }
+table { width: 100%; border-collapse: collapse; }
+th, td { text-align: left; padding: 10px 12px; border-bottom: 1px solid #22272b; }
+th { color: var(--muted); font-weight: 500; letter-spacing: .3px; }
+tr:hover td { background: #171b1f; }
+.btn { display: inline-block; padding: 10px 14px; border-radius: 10px; border: 1px solid #2a3137; background: #1a1f24; color: #e7edf2; text-decoration: none; cursor: pointer; }
+.btn:hover { background: #20262b; }
+textarea, input[type="password"] { width: 100%; background: #0f1317; color: #e7edf2; border: 1px solid #20262b; border-radius: 10px; padding: 10px 12px; }
+form .row { display: flex; gap: 12px; }
+"""
+_CSS_BYTES = _CSS.encode()
+# Content hash in the URL keeps the immutable cache safe across deploys
+_CSS_HREF = f"/admin/static/style.css?v={hashlib.sha1(_CSS_BYTES).hexdigest()[:10]}"
+_CSS_RESPONSE = Response(
+    content=_CSS_BYTES,
+    media_type="text/css",
+    headers={"Cache-Control": "public, max-age=31536000, immutable"},
+)
+
+# Static page shell built once; requests only fill the {title}/{nav}/{body} slots
+_SHELL_TMPL = """
     <!doctype html>
     <html lang="ru">
     <head>
@@ -39,50 +110,14 @@ def admin_layout(*, title: str, active: str, body: str) -> HTMLResponse:
       <meta name="viewport" content="width=device-width, initial-scale=1" />
       <title>{title} — FILS Admin</title>
       <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap" rel="stylesheet">
-      <style>
-        :root {{
-          --bg: #0f1113;
-          --panel: #15181b;
-          --muted: #7c8a99;
-          --text: #e7edf2;
-          --brand: #a4b1bc; /* спокойный серо-голубой */
-          --accent: #c9d4dc; /* светлый для границ */
-          --ok: #3ecf8e;
-          --danger: #ff5a5f;
-        }}
-        * {{ box-sizing: border-box; }}
-        body {{ margin: 0; background: var(--bg); color: var(--text); font-family: 'Roboto', system-ui, -apple-system, Segoe UI, Arial, sans-serif; }}
-        .wrap {{ display: grid; grid-template-columns: 240px 1fr; min-height: 100vh; }}
-        aside {{ background: var(--panel); border-right: 1px solid #1d2226; padding: 24px 16px; position: sticky; top: 0; height: 100vh; }}
-        .brand {{ font-weight: 700; letter-spacing: .5px; color: var(--brand); margin: 0 0 16px; }}
-        nav a {{ display: block; padding: 10px 12px; color: var(--text); text-decoration: none; border-radius: 8px; margin-bottom: 6px; border: 1px solid transparent; }}
-        nav a:hover {{ background: #1a1f24; border-color: #20262b; }}
-        nav a.active {{ background: #1b2026; border-color: var(--accent); color: #fff; }}
-        .content {{ padding: 28px 28px 48px; }}
-        h1, h2 {{ margin: 0 0 14px; font-weight: 600; }}
-        .panel {{ background: var(--panel); border: 1px solid #1d2226; border-radius: 12px; padding: 18px; }}
-        .muted {{ color: var(--muted); }}
-        .error {{ color: var(--danger); margin: 8px 0 16px; }}
-        table {{ width: 100%; border-collapse: collapse; }}
-        th, td {{ text-align: left; padding: 10px 12px; border-bottom: 1px solid #22272b; }}
-        th {{ color: var(--muted); font-weight: 500; letter-spacing: .3px; }}
-        tr:hover td {{ background: #171b1f; }}
-        .btn {{ display: inline-block; padding: 10px 14px; border-radius: 10px; border: 1px solid #2a3137; background: #1a1f24; color: #e7edf2; text-decoration: none; cursor: pointer; }}
-        .btn:hover {{ background: #20262b; }}
-        textarea, input[type="password"] {{ width: 100%; background: #0f1317; color: #e7edf2; border: 1px solid #20262b; border-radius: 10px; padding: 10px 12px; }}
-        form .row {{ display: flex; gap: 12px; }}
-      </style>
+      <link rel="stylesheet" href="{css_href}">
     </head>
     <body>
       <div class="wrap">
         <aside>
           <h3 class="brand">FILS Admin</h3>
           <nav>
-            {a('/admin', 'Главная', 'home')}
-            {a('/admin/users', 'Пользователи', 'users')}
-            {a('/admin/stats', 'Статистика', 'stats')}
-            {a('/admin/promos', 'Промокоды', 'promos')}
-            {a('/admin/broadcasts', 'Рассылки', 'broadcasts')}
+            {nav}
             <a href="/admin/logout" class="muted">Выйти</a>
           </nav>
         </aside>
@@ -93,22 +128,101 @@ def admin_layout(*, title: str, active: str, body: str) -> HTMLResponse:
     </body>
     </html>
     """
-    return HTMLResponse(html)
+
+
+def _render_nav(active: str) -> str:
+    links = []
+    for href, text, key in _NAV_ITEMS:
+        on = " class=\"active\"" if key == active else ""
+        links.append(f"<a href=\"{href}\"{on}>{text}</a>")
+    return "\n            ".join(links)
+
+
+# Only a handful of `active` keys exist, so every nav variant is rendered once
+_NAV_HTML_BY_ACTIVE = {key: _render_nav(key) for _, _, key in _NAV_ITEMS}
+
+
+def _render_admin(*, title: str, active: str, body: str) -> str:
+    # active in {"users","stats","broadcasts","promos","home"}
+    nav = _NAV_HTML_BY_ACTIVE.get(active) or _render_nav(active)
+    return _SHELL_TMPL.format(title=title, css_href=_CSS_HREF, nav=nav, body=body)
+
+
+def admin_layout(*, title: str, active: str, body: str) -> HTMLResponse:
+    return HTMLResponse(_render_admin(title=title, active=active, body=body))
+
+
+# Pages without dynamic data are rendered once at import
+_LOGIN_HTML = _render_admin(
+    title="Вход",
+    active="home",
+    body=(
+        "<h2>Вход в админку</h2>"
+        '<div class="panel">'
+        '<form method="post" action="/admin/login" class="row">'
+        '<input type="password" name="secret" placeholder="ADMIN_SECRET" />'
+        '<button class="btn" type="submit">Войти</button>'
+        "</form>"
+        "</div>"
+    ),
+)
+_HOME_HTML = _render_admin(
+    title="Главная",
+    active="home",
+    body=(
+        "<h2>FILS Admin</h2>"
+        '<div class="panel"><p class="muted">Выберите раздел слева.</p></div>'
+    ),
+)
+_BROADCASTS_HTML = _render_admin(
+    title="Рассылки",
+    active="broadcasts",
+    body=(
+        "<h2>Рассылка</h2>"
+        '<div class="panel">'
+        '<form method="post" action="/admin/broadcasts" style="display:flex; flex-direction:column; gap:12px;">'
+        '<textarea name="text" rows="6" placeholder="Текст сообщения"></textarea>'
+        '<div><button class="btn" type="submit">Отправить всем</button></div>'
+        "</form>"
+        "</div>"
+    ),
+)
+
+
+async def _ensure_ptb_app():
+    # Build (lazy import) and start PTB app once per instance. Double-checked
+    # under a lock so concurrent cold requests don't initialize it twice.
+    global ptb_app, _initialized
+    if _initialized:
+        return ptb_app
+    async with _init_lock:
+        if not _initialized:
+            if ptb_app is None:
+                from bot import build_application
+                ptb_app = build_application()
+            await ptb_app.initialize()
+            await ptb_app.start()
+            _initialized = True
+    return ptb_app
+
+
+def _ensure_schema() -> None:
+    # DDL runs once per instance; later admin pageviews skip the round-trips.
+    # The "relation does not exist" retries below force the DDL to cover schema drift.
+    global _schema_ready
+    if not _schema_ready:
+        from db import init_db
+        init_db()
+        _schema_ready = True
 
 
 @fastapi_app.on_event("startup")
 async def on_startup():
-    # Initialize DB
+    # Initialize DB (blocking driver; keep it off the event loop)
     try:
-        init_db()
+        await asyncio.to_thread(_ensure_schema)
     except Exception:
         pass
-    # Initialize and start PTB app once per instance
-    global _initialized
-    if not _initialized:
-        await ptb_app.initialize()
-        await ptb_app.start()
-        _initialized = True
     return
 
 
@@ -123,134 +237,204 @@ async def on_shutdown():
 
 @fastapi_app.get("/api/health")
 async def health():
-    # Try DB connectivity
-    db_ok = True
-    db_err = None
-    try:
-        # light-touch: stats_summary() runs SELECTs
-        _ = stats_summary()
-    except Exception as e:
-        db_ok = False
-        db_err = str(e)
-    return {"status": "ok", "bot_initialized": _initialized, "db_ok": db_ok, "db_error": db_err}
+    # Try DB connectivity; result is reused for HEALTH_TTL_SECONDS so frequent
+    # probes don't turn into constant DB load
+    now = time.monotonic()
+    if now - _health_cache["t"] > HEALTH_TTL_SECONDS:
+        from db import stats_summary
+        db_ok = True
+        db_err = None
+        try:
+            # light-touch: stats_summary() runs SELECTs; bypass its admin
+            # cache so the probe really reaches the DB
+            _ = await asyncio.to_thread(stats_summary.__wrapped__)
+        except Exception as e:
+            db_ok = False
+            db_err = str(e)
+        _health_cache.update(t=now, db_ok=db_ok, db_error=db_err)
+    return {
+        "status": "ok",
+        "bot_initialized": _initialized,
+        "db_ok": _health_cache["db_ok"],
+        "db_error": _health_cache["db_error"],
+    }
 
 
 @fastapi_app.post("/api/telegram")
 async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(default=None)):
     # Optional secret verification
     if WEBHOOK_SECRET:
-        if not x_telegram_bot_api_secret_token or x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
+        token = (x_telegram_bot_api_secret_token or "").encode()
+        if not hmac.compare_digest(token, _WEBHOOK_SECRET_B):
             raise HTTPException(status_code=403, detail="Forbidden")
 
-    data = await request.json()
+    # orjson is noticeably faster than Starlette's stdlib json on update payloads
+    data = orjson.loads(await request.body())
+    # Nothing in bot.build_application() handles other update types; skip parsing
+    if not any(k in data for k in _HANDLED_UPDATE_KEYS):
+        return _ACK
 
-    # Ensure PTB app is initialized (fallback if startup wasn't triggered)
-    global _initialized
-    if not _initialized:
-        await ptb_app.initialize()
-        await ptb_app.start()
-        _initialized = True
+    from telegram import Update
+    application = await _ensure_ptb_app()
+    from bot import process_update_and_wait
+    bot = application.bot
 
     # If it's a callback, ACK immediately to make Telegram UI responsive
     try:
         cq = data.get("callback_query")
         if cq and cq.get("id"):
-            await ptb_app.bot.answer_callback_query(callback_query_id=cq["id"], text="", cache_time=0)
+            await bot.answer_callback_query(callback_query_id=cq["id"], text="", cache_time=0)
     except Exception:
         pass
 
-    # Parse update and process (await) to avoid serverless task cancellation
-    update = Update.de_json(data=data, bot=ptb_app.bot)
-    await ptb_app.process_update(update)
+    update = Update.de_json(data=data, bot=bot)
+    if WEBHOOK_ACK_EAGER:
+        # PTB's own update fetcher (started by Application.start) dispatches it
+        application.update_queue.put_nowait(update)
+    else:
+        # Process (await) to avoid serverless task cancellation, including the
+        # DB writes/edits handlers moved off the reply path: the instance may
+        # freeze as soon as the ACK is sent
+        await process_update_and_wait(application, update)
 
-    return JSONResponse({"ok": True})
+    return _ACK
 
 
 # ---------------------- Admin area ----------------------
 
+ADMIN_COOKIE = "admin_session"
+LEGACY_ADMIN_COOKIE = "admin_secret"
+ADMIN_SESSION_TTL = 60 * 60 * 12
+# Verified session cookie -> expiry; skips the MAC on repeat requests
+_session_cache: Dict[str, int] = {}
+
+
+def _sign_session(exp: int) -> str:
+    # Cookie is "<exp>.<HMAC-SHA256(ADMIN_SECRET, exp)>", never the secret itself
+    mac = hmac.new(_ADMIN_SECRET_B, str(exp).encode(), hashlib.sha256).digest()
+    return f"{exp}.{base64.urlsafe_b64encode(mac).decode().rstrip('=')}"
+
+
 def _is_admin(request: Request) -> bool:
-    cookie = request.cookies.get("admin_secret")
-    return bool(ADMIN_SECRET) and cookie == ADMIN_SECRET
+    if not ADMIN_SECRET:
+        return False
+    cookie = request.cookies.get(ADMIN_COOKIE)
+    if not cookie:
+        return False
+    exp = _session_cache.get(cookie)
+    if exp is None:
+        exp_s = cookie.partition(".")[0]
+        # ASCII digits only and bounded, so int() can't raise (-> 500) on
+        # a huge prefix or on Unicode digits like "²" that isdigit() accepts
+        if not (exp_s.isascii() and exp_s.isdigit()) or len(exp_s) > 12 or not hmac.compare_digest(cookie.encode(), _sign_session(int(exp_s)).encode()):
+            return False
+        exp = int(exp_s)
+        if len(_session_cache) >= 1024:
+            _session_cache.clear()
+        _session_cache[cookie] = exp
+    return exp > time.time()
+
+
+# Admin pages reachable without a session
+_ADMIN_PUBLIC_PATHS = frozenset({"/admin/login", "/admin/logout", "/admin/static/style.css"})
+
+
+class AdminAuthMiddleware:
+    """Plain ASGI middleware: checks the admin session once for /admin* paths
+    and never touches the webhook/health routes (no per-route Depends)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope["path"]
+            if (path == "/admin" or path.startswith("/admin/")) and path not in _ADMIN_PUBLIC_PATHS:
+                if not _is_admin(Request(scope)):
+                    await RedirectResponse(url="/admin/login", status_code=302)(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
 
 
-async def require_admin(request: Request):
-    if not _is_admin(request):
-        raise HTTPException(status_code=302, detail="redirect", headers={"Location": "/admin/login"})
+fastapi_app.add_middleware(AdminAuthMiddleware)
+
+
+@fastapi_app.get("/admin/static/style.css")
+async def admin_css():
+    return _CSS_RESPONSE
 
 
 @fastapi_app.get("/admin/login", response_class=HTMLResponse)
 async def admin_login_page():
-    return admin_layout(
-        title="Вход",
-        active="home",
-        body=(
-            "<h2>Вход в админку</h2>"
-            '<div class="panel">'
-            '<form method="post" action="/admin/login" class="row">'
-            '<input type="password" name="secret" placeholder="ADMIN_SECRET" />'
-            '<button class="btn" type="submit">Войти</button>'
-            "</form>"
-            "</div>"
-        ),
-    )
+    return HTMLResponse(_LOGIN_HTML)
 
 
 @fastapi_app.post("/admin/login")
 async def admin_login(secret: str = Form(...)):
     if not ADMIN_SECRET:
         return PlainTextResponse("ADMIN_SECRET не задан", status_code=500)
-    if secret != ADMIN_SECRET:
+    if not hmac.compare_digest(secret.encode(), _ADMIN_SECRET_B):
         return PlainTextResponse("Неверный секрет", status_code=403)
     resp = RedirectResponse(url="/admin", status_code=302)
-    resp.set_cookie("admin_secret", ADMIN_SECRET, httponly=True, max_age=60*60*12)
+    token = _sign_session(int(time.time()) + ADMIN_SESSION_TTL)
+    resp.set_cookie(ADMIN_COOKIE, token, httponly=True, max_age=ADMIN_SESSION_TTL)
+    # Legacy cookie that held the raw secret
+    resp.delete_cookie(LEGACY_ADMIN_COOKIE)
     return resp
 
 
 @fastapi_app.get("/admin/logout")
 async def admin_logout():
     resp = RedirectResponse(url="/admin/login", status_code=302)
-    resp.delete_cookie("admin_secret")
+    resp.delete_cookie(ADMIN_COOKIE)
+    resp.delete_cookie(LEGACY_ADMIN_COOKIE)
     return resp
 
 
 @fastapi_app.get("/admin", response_class=HTMLResponse)
-async def admin_home(_: Any = Depends(require_admin)):
-    return admin_layout(
-        title="Главная",
-        active="home",
-        body=(
-            "<h2>FILS Admin</h2>"
-            '<div class="panel"><p class="muted">Выберите раздел слева.</p></div>'
-        ),
-    )
+async def admin_home():
+    return HTMLResponse(_HOME_HTML)
+
+
+# Positional slots follow db.list_users_for_admin() column order
+_USER_ROW = (
+    "<tr><td>{0}</td><td>@{1}</td><td>{2} {3}</td><td>{4}</td>"
+    "<td>{5}</td><td>{6}</td><td>{7}</td></tr>"
+).format
+
 
+def _user_row(row: tuple) -> str:
+    # Escape user-controlled values; NULL fields render as empty string
+    return _USER_ROW(*["" if v is None else escape(v) for v in row])
 
+
+# DB-backed pages are plain `def`: FastAPI runs them in its threadpool, so the
+# blocking psycopg calls never stall webhook updates on the event loop
 @fastapi_app.get("/admin/users", response_class=HTMLResponse)
-async def admin_users(_: Any = Depends(require_admin)):
+def admin_users():
+    from db import init_db, list_users_for_admin
+
     # Ensure schema
     try:
-        init_db()
+        _ensure_schema()
     except Exception:
         pass
     error_html = ""
     try:
-        users = list_users(limit=500)
+        users = list_users_for_admin(limit=500)
     except Exception as e:
         # If tables are missing, try to initialize and retry once
         msg = str(e)
         try:
             if "relation \"users\" does not exist" in msg.lower():
-                init_db()
-                users = list_users(limit=500)
+                init_db(force=True)
+                users = list_users_for_admin(limit=500)
             else:
                 raise
         except Exception:
             users = []
             error_html = f"<div style='color:#b00; margin:8px 0;'>DB error: {msg}</div>"
-    rows = "".join(
-        f"<tr><td>{u.get('telegram_id')}</td><td>@{u.get('username') or ''}</td><td>{u.get('first_name') or ''} {u.get('last_name') or ''}</td><td>{u.get('phone') or ''}</td><td>{u.get('last_model') or '-'}</td><td>{u.get('created_at')}</td><td>{u.get('last_active_at') or ''}</td></tr>"
-        for u in users
-    )
+    rows = "".join([_user_row(u) for u in users])
     return admin_layout(
         title="Пользователи",
         active="users",
@@ -270,10 +454,12 @@ async def admin_users(_: Any = Depends(require_admin)):
 
 
 @fastapi_app.get("/admin/stats", response_class=HTMLResponse)
-async def admin_stats(_: Any = Depends(require_admin)):
+def admin_stats():
+    from db import init_db, stats_summary, get_promo_stats
+
     # Ensure schema
     try:
-        init_db()
+        _ensure_schema()
     except Exception:
         pass
     try:
@@ -285,7 +471,7 @@ async def admin_stats(_: Any = Depends(require_admin)):
         msg = str(e)
         try:
             if "relation \"users\" does not exist" in msg.lower() or "relation \"submissions\" does not exist" in msg.lower():
-                init_db()
+                init_db(force=True)
                 s = stats_summary()
                 p = get_promo_stats()
                 by_model_html = "".join(f"<li>{k}: {v}</li>" for k, v in s.get("by_model", {}).items())
@@ -323,60 +509,62 @@ async def admin_stats(_: Any = Depends(require_admin)):
     )
 
 @fastapi_app.get("/admin/migrate")
-async def admin_migrate(_: Any = Depends(require_admin)):
+def admin_migrate():
+    from db import init_db
+
     try:
-        init_db()
+        init_db(force=True)
         return PlainTextResponse("OK: schema ensured")
     except Exception as e:
         return PlainTextResponse(f"Error: {e}", status_code=500)
 
 
 @fastapi_app.get("/admin/promos", response_class=HTMLResponse)
-async def admin_promos(_: Any = Depends(require_admin)):
+def admin_promos():
+    from psycopg.rows import dict_row
+
+    from db import init_db, _connect
+
     # Ensure schema
     try:
-        init_db()
+        _ensure_schema()
     except Exception:
         pass
     
     error_html = ""
     try:
         # Get recent promo codes with user info
-        from db import _connect, _DB_LOCK
-        with _DB_LOCK:
-            with _connect() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        SELECT 
-                          pc.code,
-                          pc.amount,
-                          pc.is_used,
-                          pc.used_at,
-                          pc.created_at,
-                          pc.expires_at,
-                          u.username,
-                          u.first_name,
-                          u.last_name
-                        FROM promo_codes pc
-                        LEFT JOIN users u ON pc.telegram_id = u.telegram_id
-                        ORDER BY pc.created_at DESC
-                        LIMIT 100
-                        """
-                    )
-                    cols = [d[0] for d in cur.description]
-                    rows_raw = cur.fetchall()
-        promos = [dict(zip(cols, r)) for r in rows_raw]
+        with _connect() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT 
+                      pc.code,
+                      pc.amount,
+                      pc.is_used,
+                      pc.used_at,
+                      pc.created_at,
+                      pc.expires_at,
+                      u.username,
+                      u.first_name,
+                      u.last_name
+                    FROM promo_codes pc
+                    LEFT JOIN users u ON pc.telegram_id = u.telegram_id
+                    ORDER BY pc.created_at DESC
+                    LIMIT 100
+                    """
+                )
+                promos = cur.fetchall()
         
         rows = "".join(
             f"<tr>"
             f"<td><code>{p.get('code')}</code></td>"
             f"<td>{p.get('amount')}₽</td>"
             f"<td>{'✅' if p.get('is_used') else '⏳'}</td>"
-            f"<td>@{p.get('username') or ''} {p.get('first_name') or ''} {p.get('last_name') or ''}</td>"
-            f"<td>{p.get('created_at', '')[:10] if p.get('created_at') else ''}</td>"
-            f"<td>{p.get('used_at', '')[:10] if p.get('used_at') else '-'}</td>"
-            f"<td>{p.get('expires_at', '')[:10] if p.get('expires_at') else ''}</td>"
+            f"<td>@{escape(p.get('username') or '')} {escape(p.get('first_name') or '')} {escape(p.get('last_name') or '')}</td>"
+            f"<td>{str(p['created_at'])[:10] if p.get('created_at') else ''}</td>"
+            f"<td>{str(p['used_at'])[:10] if p.get('used_at') else '-'}</td>"
+            f"<td>{str(p['expires_at'])[:10] if p.get('expires_at') else ''}</td>"
             f"</tr>"
             for p in promos
         )
@@ -385,7 +573,7 @@ async def admin_promos(_: Any = Depends(require_admin)):
         msg = str(e)
         try:
             if "relation \"promo_codes\" does not exist" in msg.lower():
-                init_db()
+                init_db(force=True)
                 promos = []
                 rows = ""
                 error_html = ""
@@ -415,53 +603,61 @@ async def admin_promos(_: Any = Depends(require_admin)):
 
 
 @fastapi_app.get("/admin/broadcasts", response_class=HTMLResponse)
-async def admin_broadcasts_page(_: Any = Depends(require_admin)):
-    return admin_layout(
-        title="Рассылки",
-        active="broadcasts",
-        body=(
-            "<h2>Рассылка</h2>"
-            '<div class="panel">'
-            '<form method="post" action="/admin/broadcasts" style="display:flex; flex-direction:column; gap:12px;">'
-            '<textarea name="text" rows="6" placeholder="Текст сообщения"></textarea>'
-            '<div><button class="btn" type="submit">Отправить всем</button></div>'
-            "</form>"
-            "</div>"
-        ),
-    )
+async def admin_broadcasts_page():
+    return HTMLResponse(_BROADCASTS_HTML)
 
 
 @fastapi_app.post("/admin/broadcasts")
-async def admin_broadcasts_send(request: Request, text: str = Form(...), _: Any = Depends(require_admin)):
+async def admin_broadcasts_send(request: Request, text: str = Form(...)):
     if not text.strip():
         return PlainTextResponse("Пустое сообщение", status_code=400)
 
-    # Collect recipients
-    users = list_users(limit=100000)
-    ids = [u.get("telegram_id") for u in users if u.get("telegram_id")]
-
-    if not ids:
-        return PlainTextResponse("Нет пользователей", status_code=200)
+    from db import iter_user_ids
 
     # Ensure bot initialized
-    global _initialized, ptb_app, BOT_TOKEN
+    global BOT_TOKEN
     if not _initialized:
         if not BOT_TOKEN:
             BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
         if not BOT_TOKEN:
             return PlainTextResponse("BOT token не настроен", status_code=500)
-        if ptb_app is None:
-            ptb_app = build_application()
-        await ptb_app.initialize()
-        await ptb_app.start()
-        _initialized = True
+    await _ensure_ptb_app()
+
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    bot = ptb_app.bot
+
+    async def _one(tid: int) -> int:
+        # Each slot is held for at least 1s, so throughput stays under
+        # BROADCAST_CONCURRENCY msg/s (Telegram allows ~30 msg/s per bot)
+        async with sem:
+            pacing = asyncio.create_task(asyncio.sleep(1.0))
+            try:
+                await bot.send_message(chat_id=tid, text=text)
+                return 1
+            except Exception:
+                return 0
+            finally:
+                await pacing
+
+    # Stream recipients from DB instead of materializing every user row
+    recipients = iter_user_ids()
+
+    def _next_page():
+        # Blocking DB read in a worker thread; only one page fetch runs at a time
+        return asyncio.create_task(asyncio.to_thread(list, islice(recipients, BROADCAST_BATCH_SIZE)))
 
     sent = 0
-    for tid in ids:
-        try:
-            await ptb_app.bot.send_message(chat_id=tid, text=text)
-            sent += 1
-        except Exception:
-            continue
-
-    return PlainTextResponse(f"Отправлено: {sent} из {len(ids)}")
+    total = 0
+    pending = _next_page()
+    while True:
+        batch = await pending
+        if not batch:
+            break
+        total += len(batch)
+        # Prefetch the following page while this batch is being sent
+        pending = _next_page()
+        sent += sum(await asyncio.gather(*(_one(tid) for tid in batch)))
+
+    if not total:
+        return PlainTextResponse("Нет пользователей", status_code=200)
+    return PlainTextResponse(f"Отправлено: {sent} из {total}")
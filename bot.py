@@ -1,9 +1,14 @@
 import asyncio
+import logging
+import math
 import os
-from typing import Dict, List
+import re
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
 
 from dotenv import load_dotenv
-from db import upsert_user, touch_user_active, add_submission, update_user_phone
+from db import upsert_user, touch_user_active, add_submission, update_user_phone, get_user_promo_codes
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -12,8 +17,9 @@ from telegram import (
     ReplyKeyboardRemove,
     Update,
 )
-from telegram.constants import ParseMode
+from telegram.constants import ChatAction, ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CallbackQueryHandler,
@@ -22,15 +28,52 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    # Malformed, negative or non-finite values fall back to the default
+    try:
+        value = float(os.getenv(name, ""))
+    except ValueError:
+        return default
+    return value if math.isfinite(value) and value >= 0 else default
+
+
+def _env_chat_id(name: str) -> Optional[int]:
+    # None (unset/invalid/0) disables manager notifications
+    try:
+        return int(os.getenv(name, "")) or None
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    bot_token: str
+    manager_chat_id: Optional[int]
+    # "Typing…" pause before promo/contact messages after the result; 0 = none
+    message_delay: float
+    # Coalescing window for manager notifications; 0 = send each one immediately
+    manager_batch_seconds: float
+
+
+def load_config() -> Config:
+    load_dotenv()
+    return Config(
+        bot_token=os.getenv("TELEGRAM_BOT_TOKEN", ""),
+        manager_chat_id=_env_chat_id("MANAGER_CHAT_ID"),
+        message_delay=_env_float("MESSAGE_DELAY_SECONDS", 0.0),
+        manager_batch_seconds=_env_float("MANAGER_BATCH_SECONDS", 2.0),
+    )
+
+
+# Single parsed source of truth for env settings
+CFG = load_config()
 
-# Load environment
-load_dotenv()
-BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-MANAGER_CHAT_ID = os.getenv("MANAGER_CHAT_ID", "")
-# Fine-grained delays
-MESSAGE_DELAY_SECONDS = float(os.getenv("MESSAGE_DELAY_SECONDS", "1.0"))
-QUESTION_DELAY_SECONDS = float(os.getenv("QUESTION_DELAY_SECONDS", os.getenv("MESSAGE_DELAY_SECONDS", "0.0")))
-RESULT_DELAY_SECONDS = float(os.getenv("RESULT_DELAY_SECONDS", os.getenv("MESSAGE_DELAY_SECONDS", "0.2")))
 
 # URLs
 URL_CLOUD = "https://filsdesign.ru/sofas/cloud"
@@ -39,135 +82,117 @@ URL_FLOUS = "https://filsdesign.ru/sofas/flous"
 URL_JUNGLE = "https://filsdesign.ru/sofas/jungle"
 URL_ALL = "https://filsdesign.ru/sofas"
 
+# At least 7 digits anywhere in the text; anchored and unambiguous, so linear time
+PHONE_LIKE_RE = re.compile(r"^(?:\D*\d){7}")
+
 # Keys for user_data
-UD_ANSWERS = "answers"  # List[int]
+UD_ANSWERS = "answers"  # int: base-5 packed answers, see pack_answer()
 UD_RESULT = "result"     # str model key
 UD_AWAITING_CONTACT = "awaiting_contact"  # bool
-UD_CONTACT_RECEIVED = "contact_received"  # bool
-
-MODELS = {
-    "CLOUD": {
-        "title": "CLOUD",
-        "desc": "Тебе подойдёт диван **CLOUD** — невероятно мягкий, будто облако. Создан для расслабления и уюта.",
-        "url": URL_CLOUD,
-    },
-    "GOCCI": {
-        "title": "GOCCI",
-        "desc": "Твоя модель — **GOCCI**. Лаконичные линии, модульность и идеальная геометрия для современных интерьеров.",
-        "url": URL_GOCCI,
-    },
-    "FLOUS": {
-        "title": "FLOUS",
-        "desc": "Рекомендуем **FLOUS** — строгий, уверенный диван с мягкой глубокой посадкой. Для тех, кто ценит стиль и комфорт без компромиссов.",
-        "url": URL_FLOUS,
-    },
-    "JUNGLE": {
-        "title": "JUNGLE",
-        "desc": "Идеальный вариант — **JUNGLE**. Низкий, широкий и невероятно комфортный диван для отдыха и общения.",
-        "url": URL_JUNGLE,
-    },
+
+@dataclass(frozen=True, slots=True)
+class Model:
+    title: str
+    desc: str
+    url: str
+
+
+MODELS: Dict[str, Model] = {
+    "CLOUD": Model(
+        title="CLOUD",
+        desc="Тебе подойдёт диван **CLOUD** — невероятно мягкий, будто облако. Создан для расслабления и уюта.",
+        url=URL_CLOUD,
+    ),
+    "GOCCI": Model(
+        title="GOCCI",
+        desc="Твоя модель — **GOCCI**. Лаконичные линии, модульность и идеальная геометрия для современных интерьеров.",
+        url=URL_GOCCI,
+    ),
+    "FLOUS": Model(
+        title="FLOUS",
+        desc="Рекомендуем **FLOUS** — строгий, уверенный диван с мягкой глубокой посадкой. Для тех, кто ценит стиль и комфорт без компромиссов.",
+        url=URL_FLOUS,
+    ),
+    "JUNGLE": Model(
+        title="JUNGLE",
+        desc="Идеальный вариант — **JUNGLE**. Низкий, широкий и невероятно комфортный диван для отдыха и общения.",
+        url=URL_JUNGLE,
+    ),
 }
 
+# Static keyboards are immutable; share one instance instead of rebuilding per call
+START_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text="👉 Начать подбор", callback_data="start_quiz")]]
+)
+CONTACT_KB = ReplyKeyboardMarkup(
+    [[KeyboardButton(text="📞 Получить консультацию", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+REMOVE_KB = ReplyKeyboardRemove()
+LINK_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text="🔍 Посмотреть все модели", url=URL_ALL)]]
+)
+# model key -> (result text, keyboard), rendered once
+RESULT_PAYLOADS = {
+    key: (
+        f"🛋 **{model.title}**\n"
+        f"> {model.desc}\n\n"
+        f"[Посмотреть {model.title} →]({model.url})",
+        LINK_KB,
+    )
+    for key, model in MODELS.items()
+}
 
-async def _ack_and_cleanup(query) -> None:
-    """Best-effort: acknowledge tap by editing message text and removing keyboard.
-    If editing text fails, try removing just the keyboard. If that fails, try deleting.
-    """
-    # Try edit text + remove keyboard
-    try:
-        await query.edit_message_text("Принято ✅")
-        return
-    except Exception:
-        pass
-    # Try only remove keyboard
-    try:
-        await query.edit_message_reply_markup(reply_markup=None)
-        return
-    except Exception:
-        pass
-    # Fallback: delete message
+
+# Off-reply-path tasks of the update being processed. Polling leaves it unset
+# (PTB awaits its tasks on Application.stop()); the serverless webhook sets a
+# fresh set per update via process_update_and_wait. Tasks copy the context on
+# creation, so nested spawns land in the same update's set
+_update_tasks: ContextVar[Optional[Set[asyncio.Task]]] = ContextVar("_update_tasks", default=None)
+
+
+def _spawn(context: ContextTypes.DEFAULT_TYPE, coro) -> None:
+    task = context.application.create_task(coro)
+    tasks = _update_tasks.get()
+    if tasks is not None:
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def process_update_and_wait(application: Application, update: Update) -> None:
+    """Process one update, then wait for the work its handlers moved off the
+    reply path (and anything that work scheduled in turn), but not for other
+    updates' tasks. Errors are left to PTB's task logging."""
+    tasks: Set[asyncio.Task] = set()
+    token = _update_tasks.set(tasks)
     try:
-        await query.message.delete()
-    except Exception:
-        pass
+        await application.process_update(update)
+    finally:
+        _update_tasks.reset(token)
+    while tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-def start_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [[InlineKeyboardButton(text="👉 Начать подбор", callback_data="start_quiz")]]
-    )
 
+def _run_db_in_background(context: ContextTypes.DEFAULT_TYPE, fn, *args) -> None:
+    """Run a blocking db.py call in a worker thread without awaiting it."""
+    _spawn(context, asyncio.to_thread(fn, *args))
 
-def q1_payload():
-    text = (
-        "🧩 Вопрос 1:\n"
-        "Где будет стоять диван?"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("1️⃣ Просторная гостиная", callback_data="q1_1")],
-        [InlineKeyboardButton("2️⃣ Студия", callback_data="q1_2")],
-        [InlineKeyboardButton("3️⃣ Офис / кабинет", callback_data="q1_3")],
-        [InlineKeyboardButton("4️⃣ Загородный дом", callback_data="q1_4")],
-    ])
-    return text, kb
-
-
-def q2_payload():
-    text = (
-        "🧩 Вопрос 2:\n"
-        "Что для тебя важнее всего?"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("1️⃣ Максимальный комфорт", callback_data="q2_1")],
-        [InlineKeyboardButton("2️⃣ Минимализм, чёткие линии", callback_data="q2_2")],
-        [InlineKeyboardButton("3️⃣ Вау‑дизайн", callback_data="q2_3")],
-        [InlineKeyboardButton("4️⃣ Модульность, простор", callback_data="q2_4")],
-    ])
-    return text, kb
-
-
-def q3_payload():
-    text = (
-        "🧩 Вопрос 3:\n"
-        "Какой стиль тебе ближе?"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("1️⃣ Современный минимализм", callback_data="q3_1")],
-        [InlineKeyboardButton("2️⃣ Лофт / урбан", callback_data="q3_2")],
-        [InlineKeyboardButton("3️⃣ Современная классика", callback_data="q3_3")],
-        [InlineKeyboardButton("4️⃣ Дорого и спокойно", callback_data="q3_4")],
-    ])
-    return text, kb
-
-
-def q4_payload():
-    text = (
-        "🧩 Вопрос 4:\n"
-        "Что ты ожидаешь от дивана?"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("1️⃣ Мягкий и уютный ☁️", callback_data="q4_1")],
-        [InlineKeyboardButton("2️⃣ Строго и стильно", callback_data="q4_2")],
-        [InlineKeyboardButton("3️⃣ Трансформируемый", callback_data="q4_3")],
-        [InlineKeyboardButton("4️⃣ Акцент в комнате", callback_data="q4_4")],
-    ])
-    return text, kb
 
+async def _safe(coro) -> None:
+    # Await a best-effort Telegram call, swallowing its errors
+    try:
+        await coro
+    except Exception as e:
+        logger.debug("background call failed: %s", e)
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    context.user_data.clear()
-    greet = (
-        "Привет 👋\n"
-        "Это квиз от **FILS Design**.\n"
-        "За 1 минуту подберём диван, который идеально впишется в твой интерьер и стиль жизни.\n"
-        "Готов начать?"
-    )
-    await update.effective_chat.send_message(
-        greet,
-        reply_markup=start_keyboard(),
-        parse_mode=ParseMode.MARKDOWN,
-    )
-    # Store/refresh user in DB (after sending greeting to reduce latency)
-    u = update.effective_user
+
+def _fire_and_forget(context: ContextTypes.DEFAULT_TYPE, coro) -> None:
+    """Schedule a best-effort coroutine off the reply path (errors are ignored)."""
+    _spawn(context, _safe(coro))
+
+
+def _persist_start(u) -> None:
     try:
         upsert_user({
             "telegram_id": u.id,
@@ -182,124 +207,170 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         pass
 
 
-async def on_start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Callback from "Начать подбор"
-    query = update.callback_query
-    await query.answer(text="Запускаем квиз…")
-    context.user_data[UD_ANSWERS] = []
-    # Edit greeting message into Q1 to ensure single-tap UX
-    text, kb = q1_payload()
+def _persist_submission(user_id: int, model_key: str, answers: List) -> None:
     try:
-        await query.edit_message_text(text=text, reply_markup=kb)
+        add_submission(user_id, model_key, answers)
+        touch_user_active(user_id)
     except Exception:
-        # Fallback to sending new message
-        await update.effective_chat.send_message(text, reply_markup=kb)
-
-
-async def send_q1(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if QUESTION_DELAY_SECONDS > 0:
-        await asyncio.sleep(QUESTION_DELAY_SECONDS)
-    text, kb = q1_payload()
-    await update.effective_chat.send_message(text, reply_markup=kb)
+        pass
 
 
-async def handle_q1(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer(text="Выбрано ✅")
-    choice = int(query.data.split("_")[1])
-    context.user_data.setdefault(UD_ANSWERS, []).append(("Q1", choice))
-    # Edit to next question in-place
-    text, kb = q2_payload()
+def _persist_phone(user_id: int, phone: str) -> None:
     try:
-        await query.edit_message_text(text=text, reply_markup=kb)
+        update_user_phone(user_id, phone)
+        touch_user_active(user_id)
     except Exception:
-        await update.effective_chat.send_message(text, reply_markup=kb)
-
-
-async def send_q2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if QUESTION_DELAY_SECONDS > 0:
-        await asyncio.sleep(QUESTION_DELAY_SECONDS)
-    text, kb = q2_payload()
-    await update.effective_chat.send_message(text, reply_markup=kb)
+        pass
 
 
-async def handle_q2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer(text="Выбрано ✅")
-    choice = int(query.data.split("_")[1])
-    context.user_data.setdefault(UD_ANSWERS, []).append(("Q2", choice))
-    # Edit to next question in-place
-    text, kb = q3_payload()
+async def _edit_or_schedule_send(context: ContextTypes.DEFAULT_TYPE, query, chat, text: str, kb) -> None:
+    """Edit the tapped message in place. If that fails, send a new message in
+    the background instead of holding the handler for a second round-trip."""
     try:
         await query.edit_message_text(text=text, reply_markup=kb)
-    except Exception:
-        await update.effective_chat.send_message(text, reply_markup=kb)
+    except Exception as e:
+        logger.warning("edit_message_text failed, sending new message instead: %s", e)
+        _spawn(context, chat.send_message(text, reply_markup=kb))
 
 
-async def send_q3(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if QUESTION_DELAY_SECONDS > 0:
-        await asyncio.sleep(QUESTION_DELAY_SECONDS)
-    text, kb = q3_payload()
-    await update.effective_chat.send_message(text, reply_markup=kb)
+def start_keyboard() -> InlineKeyboardMarkup:
+    return START_KB
+
+
+# Quiz questions are static: texts and keyboards are built once at import
+Q_PAYLOADS = (
+    (
+        (
+            "🧩 Вопрос 1:\n"
+            "Где будет стоять диван?"
+        ),
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("1️⃣ Просторная гостиная", callback_data="q1_1")],
+            [InlineKeyboardButton("2️⃣ Студия", callback_data="q1_2")],
+            [InlineKeyboardButton("3️⃣ Офис / кабинет", callback_data="q1_3")],
+            [InlineKeyboardButton("4️⃣ Загородный дом", callback_data="q1_4")],
+        ]),
+    ),
+    (
+        (
+            "🧩 Вопрос 2:\n"
+            "Что для тебя важнее всего?"
+        ),
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("1️⃣ Максимальный комфорт", callback_data="q2_1")],
+            [InlineKeyboardButton("2️⃣ Минимализм, чёткие линии", callback_data="q2_2")],
+            [InlineKeyboardButton("3️⃣ Вау‑дизайн", callback_data="q2_3")],
+            [InlineKeyboardButton("4️⃣ Модульность, простор", callback_data="q2_4")],
+        ]),
+    ),
+    (
+        (
+            "🧩 Вопрос 3:\n"
+            "Какой стиль тебе ближе?"
+        ),
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("1️⃣ Современный минимализм", callback_data="q3_1")],
+            [InlineKeyboardButton("2️⃣ Лофт / урбан", callback_data="q3_2")],
+            [InlineKeyboardButton("3️⃣ Современная классика", callback_data="q3_3")],
+            [InlineKeyboardButton("4️⃣ Дорого и спокойно", callback_data="q3_4")],
+        ]),
+    ),
+    (
+        (
+            "🧩 Вопрос 4:\n"
+            "Что ты ожидаешь от дивана?"
+        ),
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("1️⃣ Мягкий и уютный ☁️", callback_data="q4_1")],
+            [InlineKeyboardButton("2️⃣ Строго и стильно", callback_data="q4_2")],
+            [InlineKeyboardButton("3️⃣ Трансформируемый", callback_data="q4_3")],
+            [InlineKeyboardButton("4️⃣ Акцент в комнате", callback_data="q4_4")],
+        ]),
+    ),
+)
 
 
-async def handle_q3(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer(text="Выбрано ✅")
-    choice = int(query.data.split("_")[1])
-    context.user_data.setdefault(UD_ANSWERS, []).append(("Q3", choice))
-    # Edit to next question in-place
-    text, kb = q4_payload()
-    try:
-        await query.edit_message_text(text=text, reply_markup=kb)
-    except Exception:
-        await update.effective_chat.send_message(text, reply_markup=kb)
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.clear()
+    greet = (
+        "Привет 👋\n"
+        "Это квиз от **FILS Design**.\n"
+        "За 1 минуту подберём диван, который идеально впишется в твой интерьер и стиль жизни.\n"
+        "Готов начать?"
+    )
+    await update.effective_chat.send_message(
+        greet,
+        reply_markup=start_keyboard(),
+        parse_mode=ParseMode.MARKDOWN,
+    )
+    # Store/refresh user in DB in the background (off the reply path)
+    _run_db_in_background(context, _persist_start, update.effective_user)
 
 
-async def send_q4(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if QUESTION_DELAY_SECONDS > 0:
-        await asyncio.sleep(QUESTION_DELAY_SECONDS)
-    text, kb = q4_payload()
-    await update.effective_chat.send_message(text, reply_markup=kb)
+async def on_start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Callback from "Начать подбор"
+    query = update.callback_query
+    _fire_and_forget(context, query.answer(text="Запускаем квиз…"))
+    context.user_data[UD_ANSWERS] = 0
+    # Edit greeting message into Q1 to ensure single-tap UX
+    text, kb = Q_PAYLOADS[0]
+    await _edit_or_schedule_send(context, query, update.effective_chat, text, kb)
 
 
-async def handle_q4(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_q(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # One handler for all questions: callback_data is "q<question>_<choice>"
     query = update.callback_query
-    await query.answer(text="Выбрано ✅")
-    choice = int(query.data.split("_")[1])
-    context.user_data.setdefault(UD_ANSWERS, []).append(("Q4", choice))
-    # Acknowledge selection in-place
-    try:
-        await query.edit_message_text(text="Принято ✅")
-    except Exception:
-        pass
+    # Bare ACK in the background: the edited message is the visible feedback.
+    # Errors are swallowed, e.g. when the webhook already answered this query
+    _fire_and_forget(context, query.answer())
+    # Layout is fixed by the handler pattern, so read the digits by offset
+    data = query.data
+    q_idx, choice = int(data[1]), int(data[3])
+    context.user_data[UD_ANSWERS] = pack_answer(context.user_data.get(UD_ANSWERS, 0), q_idx, choice)
+    if q_idx < len(Q_PAYLOADS):
+        # Edit to next question in-place
+        text, kb = Q_PAYLOADS[q_idx]
+        await _edit_or_schedule_send(context, query, update.effective_chat, text, kb)
+    else:
+        await finish_quiz(update, context)
+
+
+async def finish_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    # Acknowledge selection in-place without waiting for the round-trip
+    _fire_and_forget(context, query.edit_message_text(text="Принято ✅"))
 
-    model_key = compute_recommendation(context.user_data.get(UD_ANSWERS, []))
+    packed = context.user_data.get(UD_ANSWERS, 0)
+    model_key = compute_recommendation(packed)
     context.user_data[UD_RESULT] = model_key
     
-    # Save submission
-    try:
-        user_id = update.effective_user.id
-        add_submission(user_id, model_key, context.user_data.get(UD_ANSWERS, []))
-        touch_user_active(user_id)
-    except Exception:
-        pass
+    # Save submission in the background
+    _run_db_in_background(context, _persist_submission, update.effective_user.id, model_key,
+                          unpack_answers(packed))
 
     # Send result first
     await send_result(update, context, model_key)
-    
-    # Then send promo code and contact separately
-    await send_promo_code(update, context)
-    await send_contact_request(update, context)
+    await _typing_pause(update, context)
+
+    # Promo and contact request are independent and sent concurrently (their
+    # relative order is not guaranteed). Failures are logged per branch, so a
+    # lost promo message never cancels or hides the lead-capture prompt;
+    # send_contact_request clears UD_AWAITING_CONTACT if its own send fails
+    results = await asyncio.gather(
+        send_promo_code(update, context),
+        send_contact_request(update, context),
+        return_exceptions=True,
+    )
+    for name, result in zip(("send_promo_code", "send_contact_request"), results):
+        if isinstance(result, Exception):
+            logger.warning("%s failed: %s", name, result)
 
 
-def compute_recommendation(answers: List) -> str:
-    # answers: list of tuples [("Q1",choice_int), ...]
+def _score(q1: int, q2: int, q3: int, q4: int) -> str:
+    # Scoring rules; only evaluated at import to fill RECO_TABLE (0 = no answer)
     score: Dict[str, int] = {"CLOUD": 0, "GOCCI": 0, "FLOUS": 0, "JUNGLE": 0}
-    amap = {key: val for key, val in answers}
 
     # Q1
-    q1 = amap.get("Q1")
     if q1 == 1:
         score["CLOUD"] += 1
         score["JUNGLE"] += 1
@@ -311,7 +382,6 @@ def compute_recommendation(answers: List) -> str:
         score["JUNGLE"] += 2
 
     # Q2
-    q2 = amap.get("Q2")
     if q2 == 1:
         score["CLOUD"] += 2
         score["JUNGLE"] += 1
@@ -327,7 +397,6 @@ def compute_recommendation(answers: List) -> str:
         score["CLOUD"] += 1
 
     # Q3
-    q3 = amap.get("Q3")
     if q3 == 1:
         score["GOCCI"] += 2
         score["CLOUD"] += 1
@@ -341,7 +410,6 @@ def compute_recommendation(answers: List) -> str:
         score["CLOUD"] += 1
 
     # Q4
-    q4 = amap.get("Q4")
     if q4 == 1:
         score["CLOUD"] += 3
     elif q4 == 2:
@@ -354,32 +422,59 @@ def compute_recommendation(answers: List) -> str:
         score["FLOUS"] += 2
         score["CLOUD"] += 1
 
-    # pick max; tie-breaker order
-    order = ["CLOUD", "GOCCI", "FLOUS", "JUNGLE"]
-    best = max(order, key=lambda m: (score[m], -order.index(m)))
+    # pick max; max() keeps the first of equal scores, so dict order is the tie-breaker
+    best = max(score, key=score.__getitem__)
     return best
 
 
+QUESTION_KEYS = ("Q1", "Q2", "Q3", "Q4")
+
+
+def pack_answer(packed: int, q_idx: int, choice: int) -> int:
+    """Set question `q_idx` (1-based) to `choice` in the packed answers int.
+    One base-5 digit per question, Q1 most significant; 0 = not answered.
+    Re-answering a question overwrites its digit."""
+    place = 5 ** (len(QUESTION_KEYS) - q_idx)
+    return packed + (choice - (packed // place) % 5) * place
+
+
+def unpack_answers(packed: int) -> List[Tuple[str, int]]:
+    # Back to [("Q1", choice), ...] for DB and manager summary; skips unanswered
+    out = []
+    for i, key in enumerate(QUESTION_KEYS):
+        val = (packed // 5 ** (len(QUESTION_KEYS) - 1 - i)) % 5
+        if val:
+            out.append((key, val))
+    return out
+
+
+# Model key for every packed answer value (4 questions x {no answer, 1..4})
+RECO_TABLE: List[str] = [
+    _score(a, b, c, d)
+    for a in range(5) for b in range(5) for c in range(5) for d in range(5)
+]
+
+
+def compute_recommendation(packed: int) -> str:
+    return RECO_TABLE[packed]
+
+
 async def send_result(update: Update, context: ContextTypes.DEFAULT_TYPE, model_key: str) -> None:
-    # Send result message first
-    if RESULT_DELAY_SECONDS > 0:
-        await asyncio.sleep(RESULT_DELAY_SECONDS)
-
-    model = MODELS[model_key]
-    text = (
-        f"🛋 **{model['title']}**\n"
-        f"> {model['desc']}\n\n"
-        f"[Посмотреть {model['title']} →]({model['url']})"
-    )
-    link_kb = InlineKeyboardMarkup(
-        [[InlineKeyboardButton(text="🔍 Посмотреть все модели", url=URL_ALL)]]
-    )
+    # No artificial delay: flood protection is the bot's AIORateLimiter
+    text, link_kb = RESULT_PAYLOADS[model_key]
     await update.effective_chat.send_message(text, parse_mode=ParseMode.MARKDOWN, reply_markup=link_kb)
 
 
+async def _typing_pause(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Optional visible pause: show "typing…" instead of silently sleeping.
+    # Off by default (MESSAGE_DELAY_SECONDS=0)
+    if CFG.message_delay <= 0:
+        return
+    _fire_and_forget(context, update.effective_chat.send_action(ChatAction.TYPING))
+    await asyncio.sleep(CFG.message_delay)
+
+
 async def send_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await asyncio.sleep(MESSAGE_DELAY_SECONDS)
-    
     promo_text = (
         "🎉 **Поздравляем!**\n\n"
         "За прохождение квиза ты получаешь промокод на **5000₽**!\n\n"
@@ -390,8 +485,6 @@ async def send_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def send_contact_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await asyncio.sleep(MESSAGE_DELAY_SECONDS)
-    
     contact_text = (
         "🎯 **Хочешь получить персональную консультацию?**\n\n"
         "Наш дизайнер поможет:\n"
@@ -403,27 +496,23 @@ async def send_contact_request(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     
     context.user_data[UD_AWAITING_CONTACT] = True
-    context.user_data[UD_CONTACT_RECEIVED] = False
-    contact_kb = ReplyKeyboardMarkup(
-        [[KeyboardButton(text="📞 Получить консультацию", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-    await update.effective_chat.send_message(contact_text, reply_markup=contact_kb)
+    try:
+        await update.effective_chat.send_message(contact_text, reply_markup=CONTACT_KB)
+    except Exception:
+        # No contact keyboard was shown, so don't wait for a phone number
+        context.user_data.pop(UD_AWAITING_CONTACT, None)
+        raise
 
 
 async def on_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Only process if we're expecting a contact
-    if not context.user_data.get(UD_AWAITING_CONTACT, False):
+    # Only process if we're expecting a contact. pop() checks and clears the flag in
+    # one step, so a concurrent on_phone_text for the same user can't also pass
+    if not context.user_data.pop(UD_AWAITING_CONTACT, False):
         return
 
     contact = update.message.contact
     user = update.effective_user
 
-    # Mark received to avoid duplicates
-    context.user_data[UD_CONTACT_RECEIVED] = True
-    context.user_data[UD_AWAITING_CONTACT] = False
-
     # Acknowledge to user
     try:
         await update.effective_chat.send_message(
@@ -433,7 +522,7 @@ async def on_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             "• Рассчитать точную стоимость\n"
             "• Ответить на все вопросы\n\n"
             "📞 Ожидайте звонка!",
-            reply_markup=ReplyKeyboardRemove(),
+            reply_markup=REMOVE_KB,
             parse_mode=ParseMode.MARKDOWN,
         )
     except Exception:
@@ -443,26 +532,18 @@ async def on_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await forward_to_manager(context, user_full_name=user.full_name, username=user.username, user_id=user.id,
                              phone=contact.phone_number, name=f"{contact.first_name} {contact.last_name or ''}")
     # Save phone to DB
-    try:
-        update_user_phone(user.id, contact.phone_number)
-        touch_user_active(user.id)
-    except Exception:
-        pass
+    _run_db_in_background(context, _persist_phone, user.id, contact.phone_number)
 
 
 async def on_phone_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Accept plain text phone numbers as a fallback
-    if not context.user_data.get(UD_AWAITING_CONTACT, False):
+    # Accept plain text phone numbers as a fallback (same check-and-clear as on_contact)
+    if not context.user_data.pop(UD_AWAITING_CONTACT, False):
         return
 
+    # Phone-likeness (>= 7 digits) is already checked by PHONE_LIKE_RE in the handler filter
     text = (update.message.text or "").strip()
-    digits = [c for c in text if c.isdigit()]
-    if len(digits) < 7:
-        return  # not a phone-like text
 
     user = update.effective_user
-    context.user_data[UD_CONTACT_RECEIVED] = True
-    context.user_data[UD_AWAITING_CONTACT] = False
 
     # Confirm to user
     try:
@@ -473,7 +554,7 @@ async def on_phone_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             "• Рассчитать точную стоимость\n"
             "• Ответить на все вопросы\n\n"
             "📞 Ожидайте звонка!",
-            reply_markup=ReplyKeyboardRemove(),
+            reply_markup=REMOVE_KB,
             parse_mode=ParseMode.MARKDOWN,
         )
     except Exception:
@@ -484,44 +565,137 @@ async def on_phone_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                              phone=text, name=user.full_name)
 
 
+def _manager_template(title: str, url: str) -> str:
+    # Per-request fields stay as str.format slots; model title/url are baked in
+    return (
+        "Новая заявка из бота FILS Design — подбор дивана:\n"
+        "Пользователь: {user_full_name} (@{username}; id={user_id})\n"
+        "Телефон: {phone}\n"
+        "Имя: {name}\n"
+        "\n"
+        "Ответы квиза:{answers}\n"
+        "\n"
+        f"Рекомендация: {title}\n"
+        f"Ссылка: {url}"
+    )
+
+
+MANAGER_TEMPLATES = {key: _manager_template(m.title, m.url) for key, m in MODELS.items()}
+
+
 async def forward_to_manager(context: ContextTypes.DEFAULT_TYPE, *, user_full_name: str, username: str, user_id: int,
                              phone: str, name: str) -> None:
+    if CFG.manager_chat_id is None:
+        return
     try:
-        answers = context.user_data.get(UD_ANSWERS, [])
+        answers = unpack_answers(context.user_data.get(UD_ANSWERS, 0))
         model_key = context.user_data.get(UD_RESULT, "?")
         
         # Get user's latest promo code
-        from db import get_user_promo_codes
-        user_promos = get_user_promo_codes(user_id)
+        user_promos = await asyncio.to_thread(get_user_promo_codes, user_id)
         latest_promo = user_promos[0] if user_promos else None
         
-        lines = [
-            "Новая заявка из бота FILS Design — подбор дивана:",
-            f"Пользователь: {user_full_name} (@{username or '-'}; id={user_id})",
-            f"Телефон: {phone}",
-            f"Имя: {name}",
-            "",
-            "Ответы квиза:",
-        ]
-        for q, val in answers:
-            lines.append(f" - {q}: {val}")
-        model = MODELS.get(model_key, {"title": model_key})
-        lines.append("")
-        lines.append(f"Рекомендация: {model.get('title', model_key)}")
-        lines.append(f"Ссылка: {model.get('url', URL_ALL)}")
-        
+        template = MANAGER_TEMPLATES.get(model_key) or _manager_template(model_key, URL_ALL)
+        text = template.format(
+            user_full_name=user_full_name,
+            username=username or "-",
+            user_id=user_id,
+            phone=phone,
+            name=name,
+            answers="".join(f"\n - {q}: {val}" for q, val in answers),
+        )
         if latest_promo:
-            lines.append("")
-            lines.append(f"🎁 Выдан промокод: {latest_promo['code']} (5000₽)")
+            text += f"\n\n🎁 Выдан промокод: {latest_promo['code']} (5000₽)"
 
-        manager_chat_id = int(MANAGER_CHAT_ID) if MANAGER_CHAT_ID else None
-        if manager_chat_id:
-            await context.bot.send_message(chat_id=manager_chat_id, text="\n".join(lines))
+        if _manager_queue is not None:
+            _manager_queue.put_nowait(text)
+        else:
+            await context.bot.send_message(chat_id=CFG.manager_chat_id, text=text)
     except Exception:
         # Silent failure to not break user UX
         pass
 
 
+# Manager notifications landing within MANAGER_BATCH_SECONDS are joined into
+# as few messages as fit Telegram's length cap. The worker only runs under
+# run_polling (post_init); otherwise forward_to_manager sends directly
+MANAGER_MESSAGE_LIMIT = 4096
+MANAGER_BATCH_SEPARATOR = "\n\n---\n\n"
+_manager_queue: Optional[asyncio.Queue] = None
+_manager_task: Optional[asyncio.Task] = None
+
+
+def _pack_manager_batch(texts: List[str]) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for text in texts:
+        text = text[:MANAGER_MESSAGE_LIMIT]
+        if current and len(current) + len(MANAGER_BATCH_SEPARATOR) + len(text) > MANAGER_MESSAGE_LIMIT:
+            chunks.append(current)
+            current = text
+        else:
+            current = current + MANAGER_BATCH_SEPARATOR + text if current else text
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def _flush_manager(bot, texts: List[str]) -> None:
+    for chunk in _pack_manager_batch(texts):
+        try:
+            await bot.send_message(chat_id=CFG.manager_chat_id, text=chunk)
+        except Exception as e:
+            logger.warning("manager notification failed: %s", e)
+
+
+async def _manager_worker(bot, queue: asyncio.Queue) -> None:
+    texts: List[str] = []
+    try:
+        while True:
+            texts.append(await queue.get())
+            await asyncio.sleep(CFG.manager_batch_seconds)
+            while not queue.empty():
+                texts.append(queue.get_nowait())
+            batch, texts = texts, []
+            # Shielded: a stop() mid-flush lets this batch finish once instead
+            # of re-sending chunks that were already delivered
+            flush = asyncio.ensure_future(_flush_manager(bot, batch))
+            try:
+                await asyncio.shield(flush)
+            except asyncio.CancelledError:
+                await flush
+                raise
+    except asyncio.CancelledError:
+        # Stopping: send whatever is still buffered (never the batch in flight)
+        while not queue.empty():
+            texts.append(queue.get_nowait())
+        if texts:
+            await _flush_manager(bot, texts)
+        raise
+
+
+async def _start_manager_batching(app: Application) -> None:
+    global _manager_queue, _manager_task
+    if CFG.manager_chat_id is None or CFG.manager_batch_seconds <= 0:
+        return
+    _manager_queue = asyncio.Queue()
+    _manager_task = asyncio.create_task(_manager_worker(app.bot, _manager_queue))
+
+
+async def _stop_manager_batching(app: Application) -> None:
+    global _manager_queue, _manager_task
+    if _manager_task is None:
+        return
+    # Detach the queue first so late notifications go out directly
+    _manager_queue = None
+    _manager_task.cancel()
+    try:
+        await _manager_task
+    except asyncio.CancelledError:
+        pass
+    _manager_task = None
+
+
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_chat.send_message(
         "Это бот-линквиз для подбора дивана FILS Design. Нажми 'Начать подбор' чтобы пройти квиз.",
@@ -529,10 +703,36 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 def build_application() -> Application:
-    if not BOT_TOKEN:
+    if not CFG.bot_token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set. See .env.example")
-
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    if CFG.manager_chat_id is None and os.getenv("MANAGER_CHAT_ID"):
+        # Parsed once in load_config(); say so loudly instead of silently dropping leads
+        logger.error("MANAGER_CHAT_ID=%r is not a valid chat id; manager notifications are disabled",
+                     os.getenv("MANAGER_CHAT_ID"))
+
+    # Default builder uses a single pooled connection and handles updates strictly
+    # one by one; widen the pool, multiplex over HTTP/2 and dispatch concurrently
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        pool_timeout=5.0,
+        read_timeout=20.0,
+        write_timeout=20.0,
+        http_version="2",
+    )
+    get_updates_request = HTTPXRequest(connection_pool_size=8, http_version="2")
+    app = (
+        ApplicationBuilder()
+        .token(CFG.bot_token)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(True)
+        .post_init(_start_manager_batching)
+        .post_stop(_stop_manager_batching)
+        # Queue outgoing calls under Telegram's ~30 msg/s bot-wide limit and
+        # retry RetryAfter centrally instead of in every handler
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .build()
+    )
 
     # Commands
     app.add_handler(CommandHandler("start", cmd_start))
@@ -540,23 +740,28 @@ def build_application() -> Application:
 
     # Callbacks for quiz
     app.add_handler(CallbackQueryHandler(on_start_quiz, pattern=r"^start_quiz$"))
-    app.add_handler(CallbackQueryHandler(handle_q1, pattern=r"^q1_([1-4])$"))
-    app.add_handler(CallbackQueryHandler(handle_q2, pattern=r"^q2_([1-4])$"))
-    app.add_handler(CallbackQueryHandler(handle_q3, pattern=r"^q3_([1-4])$"))
-    app.add_handler(CallbackQueryHandler(handle_q4, pattern=r"^q4_([1-4])$"))
+    app.add_handler(CallbackQueryHandler(handle_q, pattern=r"^q[1-4]_[1-4]$"))
 
     # Contact messages
     app.add_handler(MessageHandler(filters.CONTACT, on_contact))
     # Fallback: accept phone numbers typed as text
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), on_phone_text))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND) & filters.Regex(PHONE_LIKE_RE), on_phone_text))
 
     return app
 
 
 def main() -> None:
+    try:
+        import uvloop
+    except ImportError:  # not installed on Windows; stdlib loop works fine
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     app = build_application()
     print("FILS Design quiz bot is running...")
-    app.run_polling()
+    # Only fetch the update types we have handlers for; longer long-poll
+    # timeout means fewer empty getUpdates round-trips when idle
+    app.run_polling(allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY], timeout=30)
 
 
 if __name__ == "__main__":
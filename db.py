@@ -1,256 +1,501 @@
+import base64
+import copy
 import os
-import json
 import threading
-from datetime import datetime
-from typing import Any, Dict, List, Tuple
+import time
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-import psycopg
-
-_DB_LOCK = threading.Lock()
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
 
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Max wait for a pooled connection: room for a Neon compute wake-up, but an
+# unreachable DB fails fast instead of psycopg_pool's 30s default
+POOL_TIMEOUT_SECONDS = 5.0
+_POOL: Optional[ConnectionPool] = None
+_POOL_LOCK = threading.Lock()
 
-def _connect():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set (Neon Postgres)")
-    # psycopg will parse the URL (sslmode is typically required on Neon)
-    return psycopg.connect(DATABASE_URL, autocommit=True)
+# last_active_at only feeds the admin panel, so each user's timestamp is written
+# at most once per TOUCH_INTERVAL_SECONDS; touches in between skip the round-trip
+TOUCH_INTERVAL_SECONDS = 60.0
+_TOUCH_PRUNE_SIZE = 10000
+_last_touch: Dict[int, float] = {}
+_TOUCH_LOCK = threading.Lock()
 
 
-def init_db() -> None:
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS users (
-                      telegram_id BIGINT PRIMARY KEY,
-                      username TEXT,
-                      first_name TEXT,
-                      last_name TEXT,
-                      language_code TEXT,
-                      is_bot BOOLEAN DEFAULT FALSE,
-                      phone TEXT,
-                      created_at TIMESTAMPTZ,
-                      updated_at TIMESTAMPTZ,
-                      last_active_at TIMESTAMPTZ
-                    );
-                    """
-                )
-                cur.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS submissions (
-                      id BIGSERIAL PRIMARY KEY,
-                      telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE SET NULL,
-                      model TEXT,
-                      answers_json TEXT,
-                      created_at TIMESTAMPTZ
-                    );
-                    """
-                )
-                cur.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS promo_codes (
-                      id BIGSERIAL PRIMARY KEY,
-                      code TEXT UNIQUE NOT NULL,
-                      telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE SET NULL,
-                      amount INTEGER DEFAULT 5000,
-                      is_used BOOLEAN DEFAULT FALSE,
-                      used_at TIMESTAMPTZ,
-                      created_at TIMESTAMPTZ,
-                      expires_at TIMESTAMPTZ
-                    );
-                    """
+def _pool() -> ConnectionPool:
+    # Created on first use so importing db.py never needs DATABASE_URL
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL is not set (Neon Postgres)")
+                # psycopg will parse the URL (sslmode is typically required on Neon).
+                # check= revalidates connections Neon may have dropped while idle
+                _POOL = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=2,
+                    max_size=10,
+                    kwargs={"autocommit": True},
+                    check=ConnectionPool.check_connection,
+                    timeout=POOL_TIMEOUT_SECONDS,
+                    open=True,
                 )
+    return _POOL
 
 
-def upsert_user(user: Dict[str, Any]) -> None:
-    now = datetime.utcnow().isoformat()
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO users (telegram_id, username, first_name, last_name, language_code, is_bot, created_at, updated_at, last_active_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (telegram_id) DO UPDATE SET
-                      username=EXCLUDED.username,
-                      first_name=EXCLUDED.first_name,
-                      last_name=EXCLUDED.last_name,
-                      language_code=EXCLUDED.language_code,
-                      is_bot=EXCLUDED.is_bot,
-                      updated_at=EXCLUDED.updated_at,
-                      last_active_at=EXCLUDED.last_active_at
-                    ;
-                    """,
-                    (
-                        user.get("telegram_id"),
-                        user.get("username"),
-                        user.get("first_name"),
-                        user.get("last_name"),
-                        user.get("language_code"),
-                        bool(user.get("is_bot")),
-                        now,
-                        now,
-                        now,
-                    ),
-                )
+# Admin reads change slowly; repeated page loads within the TTL skip the DB
+ADMIN_CACHE_TTL_SECONDS = 30.0
+_CACHE_MAX_ENTRIES = 256
+_cache: Dict[Tuple[Any, ...], Tuple[float, Any]] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def _ttl_cached(fn: Callable) -> Callable:
+    """Errors are not cached. Callers get a deep copy, so mutating a result
+    never changes what the next caller sees. The uncached function stays on
+    fn.__wrapped__."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with _CACHE_LOCK:
+            hit = _cache.get(key)
+        if hit is not None and now - hit[0] < ADMIN_CACHE_TTL_SECONDS:
+            return copy.deepcopy(hit[1])
+        value = fn(*args, **kwargs)
+        with _CACHE_LOCK:
+            # Keys include arguments (e.g. list_users cursors): drop expired
+            # entries on store, and start over if live ones still hit the cap
+            for k in [k for k, (t, _) in _cache.items() if now - t >= ADMIN_CACHE_TTL_SECONDS]:
+                del _cache[k]
+            if len(_cache) >= _CACHE_MAX_ENTRIES:
+                _cache.clear()
+            _cache[key] = (now, value)
+        return copy.deepcopy(value)
+    return wrapper
+
+
+def _connect():
+    """Borrow a pooled connection: `with _connect() as conn:` hands it back to
+    the pool on exit instead of closing it, so calls skip the TCP/TLS handshake."""
+    return _pool().connection()
+
+
+# Last object init_db() creates; if it exists the whole schema is in place.
+# Keep it pointing at the final DDL statement when adding new ones
+_SCHEMA_SENTINEL = "idx_promo_active"
+
+
+def init_db(force: bool = False) -> None:
+    """Create/upgrade the schema. Skipped when it is already in place unless `force`."""
+    with _connect() as conn:
+        # Steady state: one catalog lookup instead of re-running every DDL statement
+        if not force and conn.execute("SELECT to_regclass(%s) IS NOT NULL", (_SCHEMA_SENTINEL,)).fetchone()[0]:
+            return
+        _create_schema(conn)
+
+
+def _create_schema(conn) -> None:
+    # Pipeline mode sends all DDL statements back-to-back: one round-trip, not one each
+    with conn.pipeline():
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                  telegram_id BIGINT PRIMARY KEY,
+                  username TEXT,
+                  first_name TEXT,
+                  last_name TEXT,
+                  language_code TEXT,
+                  is_bot BOOLEAN DEFAULT FALSE,
+                  phone TEXT,
+                  created_at TIMESTAMPTZ,
+                  updated_at TIMESTAMPTZ,
+                  last_active_at TIMESTAMPTZ
+                );
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS submissions (
+                  id BIGSERIAL PRIMARY KEY,
+                  telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE SET NULL,
+                  model TEXT,
+                  answers_json JSONB,
+                  created_at TIMESTAMPTZ
+                );
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS promo_codes (
+                  id BIGSERIAL PRIMARY KEY,
+                  code TEXT UNIQUE NOT NULL,
+                  telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE SET NULL,
+                  amount INTEGER DEFAULT 5000,
+                  is_used BOOLEAN DEFAULT FALSE,
+                  used_at TIMESTAMPTZ,
+                  created_at TIMESTAMPTZ,
+                  expires_at TIMESTAMPTZ
+                );
+                """
+            )
+            # Tables created before answers_json became JSONB still have TEXT
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                  IF (SELECT data_type FROM information_schema.columns
+                      WHERE table_schema = current_schema()
+                        AND table_name = 'submissions' AND column_name = 'answers_json') = 'text' THEN
+                    ALTER TABLE submissions ALTER COLUMN answers_json TYPE JSONB USING answers_json::jsonb;
+                  END IF;
+                END $$;
+                """
+            )
+            # Latest-model lookup per user (admin users page), newest-first user
+            # listing, and per-user promo lookups (manager notification)
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_submissions_tid_created ON submissions (telegram_id, created_at DESC)"
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at DESC, telegram_id DESC)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_telegram_id ON promo_codes (telegram_id)")
+            # Partial indexes for get_promo_stats: used codes (covering amount
+            # for the SUM) and unused codes by expiry
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_promo_used ON promo_codes (used_at) INCLUDE (amount) WHERE is_used = TRUE"
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_promo_active ON promo_codes (expires_at) WHERE is_used = FALSE"
+            )
+
+
+# Hot per-update writes run with prepare=True: each pooled connection parses
+# and plans them once, then reuses the server-side statement
+_SQL_UPSERT_USER = """
+    INSERT INTO users (telegram_id, username, first_name, last_name, language_code, is_bot, created_at, updated_at, last_active_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+      username=EXCLUDED.username,
+      first_name=EXCLUDED.first_name,
+      last_name=EXCLUDED.last_name,
+      language_code=EXCLUDED.language_code,
+      is_bot=EXCLUDED.is_bot,
+      updated_at=EXCLUDED.updated_at,
+      last_active_at=EXCLUDED.last_active_at
+    RETURNING telegram_id, username, first_name, last_name, phone, language_code, is_bot,
+              created_at, updated_at, last_active_at
+"""
+_SQL_UPDATE_PHONE = "UPDATE users SET phone=%s, updated_at=%s, last_active_at=%s WHERE telegram_id=%s"
+_SQL_TOUCH = "UPDATE users SET last_active_at=%s WHERE telegram_id=%s"
+_SQL_ADD_SUBMISSION = "INSERT INTO submissions (telegram_id, model, answers_json, created_at) VALUES (%s, %s, %s, %s)"
+
+
+def upsert_user(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Insert or refresh a user; returns the stored row (same round-trip)."""
+    now = datetime.now(timezone.utc)
+    with _connect() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                _SQL_UPSERT_USER,
+                (
+                    user.get("telegram_id"),
+                    user.get("username"),
+                    user.get("first_name"),
+                    user.get("last_name"),
+                    user.get("language_code"),
+                    bool(user.get("is_bot")),
+                    now,
+                    now,
+                    now,
+                ),
+                prepare=True,
+            )
+            row = cur.fetchone()
+    _claim_touch(user.get("telegram_id"))
+    return row
+
+
+def _claim_touch(telegram_id: int) -> bool:
+    """Record that last_active_at is being written now. False if it already was
+    within TOUCH_INTERVAL_SECONDS (in this process)."""
+    now = time.monotonic()
+    with _TOUCH_LOCK:
+        last = _last_touch.get(telegram_id)
+        if last is not None and now - last < TOUCH_INTERVAL_SECONDS:
+            return False
+        if len(_last_touch) >= _TOUCH_PRUNE_SIZE:
+            cutoff = now - TOUCH_INTERVAL_SECONDS
+            for tid in [tid for tid, t in _last_touch.items() if t < cutoff]:
+                del _last_touch[tid]
+        _last_touch[telegram_id] = now
+        return True
 
 
 def update_user_phone(telegram_id: int, phone: str) -> None:
-    now = datetime.utcnow().isoformat()
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE users SET phone=%s, updated_at=%s, last_active_at=%s WHERE telegram_id=%s",
-                    (phone, now, now, telegram_id),
-                )
+    now = datetime.now(timezone.utc)
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                _SQL_UPDATE_PHONE,
+                (phone, now, now, telegram_id),
+                prepare=True,
+            )
+    _claim_touch(telegram_id)
 
 
 def touch_user_active(telegram_id: int) -> None:
-    now = datetime.utcnow().isoformat()
-    with _DB_LOCK:
+    if not _claim_touch(telegram_id):
+        return
+    now = datetime.now(timezone.utc)
+    try:
         with _connect() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "UPDATE users SET last_active_at=%s WHERE telegram_id=%s",
+                    _SQL_TOUCH,
                     (now, telegram_id),
+                    prepare=True,
                 )
+    except Exception:
+        # Nothing was stored: release the claim so the next touch retries.
+        # Any earlier claim had expired already, so dropping it loses nothing
+        with _TOUCH_LOCK:
+            _last_touch.pop(telegram_id, None)
+        raise
 
 
 def add_submission(telegram_id: int, model: str, answers: List[Tuple[str, int]]) -> None:
-    now = datetime.utcnow().isoformat()
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO submissions (telegram_id, model, answers_json, created_at) VALUES (%s, %s, %s, %s)",
-                    (telegram_id, model, json.dumps(answers, ensure_ascii=False), now),
+    now = datetime.now(timezone.utc)
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                _SQL_ADD_SUBMISSION,
+                (telegram_id, model, Jsonb(answers), now),
+                prepare=True,
+            )
+
+
+# Above this many rows COPY beats a pipelined executemany
+BULK_COPY_THRESHOLD = 1024
+
+
+def add_submissions_bulk(items: List[Tuple[int, str, List[Tuple[str, int]], datetime]]) -> None:
+    """Insert many (telegram_id, model, answers, created_at) rows in one go,
+    e.g. for backfills."""
+    if not items:
+        return
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            if len(items) >= BULK_COPY_THRESHOLD:
+                with cur.copy("COPY submissions (telegram_id, model, answers_json, created_at) FROM STDIN") as cp:
+                    for telegram_id, model, answers, created_at in items:
+                        cp.write_row((telegram_id, model, Jsonb(answers), created_at))
+            else:
+                # psycopg pipelines executemany: one round-trip for the batch
+                cur.executemany(
+                    _SQL_ADD_SUBMISSION,
+                    [(telegram_id, model, Jsonb(answers), created_at) for telegram_id, model, answers, created_at in items],
                 )
 
 
-def list_users(limit: int = 200, offset: int = 0) -> List[Dict[str, Any]]:
-    with _DB_LOCK:
+@_ttl_cached
+def list_users(
+    limit: int = 200, after: Optional[Tuple[datetime, int]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[datetime, int]]]:
+    """Newest users first, one page at a time (keyset on created_at, telegram_id).
+    Returns (rows, cursor); pass the cursor back as `after` for the next page.
+    The cursor is None on the last page."""
+    where = ""
+    params: Tuple[Any, ...] = (limit,)
+    if after is not None:
+        where = "WHERE (u.created_at, u.telegram_id) < (%s, %s)"
+        params = (after[0], after[1], limit)
+    with _connect() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                """
+                SELECT
+                  u.telegram_id,
+                  u.username,
+                  u.first_name,
+                  u.last_name,
+                  u.phone,
+                  u.language_code,
+                  u.is_bot,
+                  u.created_at,
+                  u.updated_at,
+                  u.last_active_at,
+                  s.model AS last_model
+                FROM users u
+                LEFT JOIN LATERAL (
+                  SELECT model
+                  FROM submissions
+                  WHERE telegram_id = u.telegram_id
+                  ORDER BY created_at DESC
+                  LIMIT 1
+                ) s ON TRUE
+                {where}
+                ORDER BY u.created_at DESC, u.telegram_id DESC
+                LIMIT %s
+                """.format(where=where),
+                params,
+            )
+            rows = cur.fetchall()
+    cursor = (rows[-1]["created_at"], rows[-1]["telegram_id"]) if len(rows) == limit else None
+    return rows, cursor
+
+
+@_ttl_cached
+def list_users_for_admin(limit: int = 500) -> List[Tuple[Any, ...]]:
+    """Rows for the admin users table, only the columns it renders:
+    (telegram_id, username, first_name, last_name, phone, last_model, created_at, last_active_at)"""
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                  u.telegram_id,
+                  u.username,
+                  u.first_name,
+                  u.last_name,
+                  u.phone,
+                  COALESCE(s.model, '-') AS last_model,
+                  u.created_at,
+                  u.last_active_at
+                FROM users u
+                LEFT JOIN LATERAL (
+                  SELECT model
+                  FROM submissions
+                  WHERE telegram_id = u.telegram_id
+                  ORDER BY created_at DESC
+                  LIMIT 1
+                ) s ON TRUE
+                ORDER BY u.created_at DESC
+                LIMIT %s
+                """,
+                (limit,),
+            )
+            return cur.fetchall()
+
+
+def iter_user_ids(batch_size: int = 1000) -> Iterator[int]:
+    """Yield all user telegram_ids, fetched page by page (keyset on PK).
+    A pooled connection is held only per page, never across a yield."""
+    last_id = None
+    while True:
         with _connect() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT
-                      u.telegram_id,
-                      u.username,
-                      u.first_name,
-                      u.last_name,
-                      u.phone,
-                      u.language_code,
-                      u.is_bot,
-                      u.created_at,
-                      u.updated_at,
-                      u.last_active_at,
-                      (
-                        SELECT s.model
-                        FROM submissions s
-                        WHERE s.telegram_id = u.telegram_id
-                        ORDER BY s.created_at DESC
-                        LIMIT 1
-                      ) AS last_model
-                    FROM users u
-                    ORDER BY u.created_at DESC
-                    LIMIT %s OFFSET %s
-                    """,
-                    (limit, offset),
-                )
-                cols = [d[0] for d in cur.description]
-                rows_raw = cur.fetchall()
-    return [dict(zip(cols, r)) for r in rows_raw]
+                if last_id is None:
+                    cur.execute(
+                        "SELECT telegram_id FROM users ORDER BY telegram_id LIMIT %s",
+                        (batch_size,),
+                    )
+                else:
+                    cur.execute(
+                        "SELECT telegram_id FROM users WHERE telegram_id > %s ORDER BY telegram_id LIMIT %s",
+                        (last_id, batch_size),
+                    )
+                page = [r[0] for r in cur.fetchall()]
+        yield from page
+        if len(page) < batch_size:
+            return
+        last_id = page[-1]
 
 
+@_ttl_cached
 def stats_summary() -> Dict[str, Any]:
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users")
-                users_count = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM submissions")
-                subs_count = cur.fetchone()[0]
-                cur.execute("SELECT model, COUNT(*) FROM submissions GROUP BY model ORDER BY COUNT(*) DESC")
-                pairs = cur.fetchall()
-    by_model = {k: v for k, v in pairs}
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            # One round-trip; by_model comes back as [[model, count], ...] (json keeps the order)
+            cur.execute(
+                """
+                SELECT
+                  (SELECT COUNT(*) FROM users),
+                  (SELECT COUNT(*) FROM submissions),
+                  (
+                    SELECT json_agg(json_build_array(model, c) ORDER BY c DESC)
+                    FROM (SELECT model, COUNT(*) AS c FROM submissions GROUP BY model) t
+                  )
+                """
+            )
+            users_count, subs_count, pairs = cur.fetchone()
+    by_model = {k: v for k, v in pairs or ()}
     return {"users": users_count, "submissions": subs_count, "by_model": by_model}
 
 
+def _new_promo_code() -> str:
+    # FILS + 6 base32 chars (A-Z, 2-7) from the OS CSPRNG: ~1e9 codes, hard to guess
+    return "FILS" + base64.b32encode(os.urandom(4)).decode("ascii")[:6]
+
+
 def generate_promo_code(telegram_id: int, amount: int = 5000) -> str:
     """Generate a unique promo code for user"""
-    import random
-    import string
-    
-    now = datetime.utcnow()
+    now = datetime.now(timezone.utc)
     expires_at = now.replace(year=now.year + 1)  # Valid for 1 year
     
-    # Generate code: FILS + 6 random chars
-    random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    code = f"FILS{random_part}"
-    
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                # Ensure uniqueness
-                attempts = 0
-                while attempts < 10:  # Prevent infinite loop
-                    cur.execute("SELECT id FROM promo_codes WHERE code = %s", (code,))
-                    if not cur.fetchone():
-                        break
-                    random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-                    code = f"FILS{random_part}"
-                    attempts += 1
-                
-                if attempts >= 10:
-                    raise Exception("Failed to generate unique code after 10 attempts")
-                
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            # Collisions are rare: let the UNIQUE constraint detect them and
+            # retry with a new code, instead of a SELECT before every INSERT
+            for _ in range(10):  # Prevent infinite loop
+                code = _new_promo_code()
                 cur.execute(
                     """
                     INSERT INTO promo_codes (code, telegram_id, amount, created_at, expires_at)
                     VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (code) DO NOTHING
+                    RETURNING code
                     """,
-                    (code, telegram_id, amount, now.isoformat(), expires_at.isoformat())
+                    (code, telegram_id, amount, now, expires_at)
                 )
-    
-    return code
+                if cur.fetchone():
+                    return code
+
+    raise Exception("Failed to generate unique code after 10 attempts")
 
 
 def get_user_promo_codes(telegram_id: int) -> List[Dict[str, Any]]:
     """Get all promo codes for a user"""
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT code, amount, is_used, used_at, created_at, expires_at
-                    FROM promo_codes 
-                    WHERE telegram_id = %s 
-                    ORDER BY created_at DESC
-                    """,
-                    (telegram_id,)
-                )
-                cols = [d[0] for d in cur.description]
-                rows_raw = cur.fetchall()
-    return [dict(zip(cols, r)) for r in rows_raw]
+    with _connect() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                """
+                SELECT code, amount, is_used, used_at, created_at, expires_at
+                FROM promo_codes 
+                WHERE telegram_id = %s 
+                ORDER BY created_at DESC
+                """,
+                (telegram_id,)
+            )
+            return cur.fetchall()
 
 
+@_ttl_cached
 def get_promo_stats() -> Dict[str, Any]:
     """Get promo codes statistics"""
-    with _DB_LOCK:
-        with _connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM promo_codes")
-                total_codes = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM promo_codes WHERE is_used = TRUE")
-                used_codes = cur.fetchone()[0]
-                cur.execute("SELECT SUM(amount) FROM promo_codes WHERE is_used = TRUE")
-                total_used_amount = cur.fetchone()[0] or 0
-                cur.execute("SELECT COUNT(*) FROM promo_codes WHERE expires_at > NOW() AND is_used = FALSE")
-                active_codes = cur.fetchone()[0]
+    with _connect() as conn:
+        with conn.cursor() as cur:
+            # One round-trip. The used and active figures are separate subqueries
+            # whose WHERE clauses match the partial indexes idx_promo_used
+            # (covering amount) and idx_promo_active, so they only read those
+            cur.execute(
+                """
+                SELECT
+                  (SELECT COUNT(*) FROM promo_codes),
+                  used.cnt,
+                  used.total,
+                  (SELECT COUNT(*) FROM promo_codes WHERE is_used = FALSE AND expires_at > NOW())
+                FROM (SELECT COUNT(*) AS cnt, SUM(amount) AS total FROM promo_codes WHERE is_used = TRUE) used
+                """
+            )
+            total_codes, used_codes, total_used_amount, active_codes = cur.fetchone()
+            total_used_amount = total_used_amount or 0
     return {
         "total_codes": total_codes,
         "used_codes": used_codes,